@@ -37,6 +37,9 @@ stream.stream(n): returns first n rows from CSV file
 (no proper slicing because it takes unpredictable lengths of time to do anything;
 if you want, use itertools.islice)
 
+stream.offset: byte offset just past the last row read; 
+stream.stream_from_offset(offset) picks up again from there (e.g. after a restart)
+
 
 Provides a decorator for function to transform a field value (or multiple): 
 
@@ -72,17 +75,34 @@ at any point in setup (applied before stream() runs).
 import csv
 import functools
 import itertools
-from collections import namedtuple
+import mmap
+import os
+import re
+from collections import deque, namedtuple
+
+
+_line_end_re = re.compile(rb'\r\n?|\n') # Same line endings as newline='' recognises
+
+
+def _identity(value):
+    return value
+
+@functools.lru_cache(maxsize=4096)
+def snakecase(string):
+    return string.lower().replace(' ', '_')
 
 
 class CSV_Error(Exception):
     pass
 
 class CSV_Gen:
-    def __init__(self, file_path=None, field_names='header'):
+    def __init__(self, file_path=None, field_names='header', encoding='utf-8'):
         
         self._value_transformers = {} # Obviously can set this directly; or not?
         self._field_names = field_names
+        self.encoding = encoding
+        self._mmap = None
+        self.offset = 0
         
         if file_path:
             self.file_path = file_path
@@ -111,15 +131,62 @@ class CSV_Gen:
     @file_path.setter
     def file_path(self, path):
         self._file_path = path
-        self.set_csv_dialect()
+        self._mmap = None # Don't close it; a running stream may still be using the old one
+        self._probe_csv()
         if self._field_names == 'header':
             self.get_field_names_from_csv()
             
 
+    def _mapped_file(self):
+        ''' Map the CSV file into memory once; sniffing, header reading and streaming all share it '''
+        if self._mmap is None:
+            with open(self.file_path, 'rb') as csv_file:
+                if not os.fstat(csv_file.fileno()).st_size:
+                    self._mmap = b'' # Can't map an empty file; sniffing it fails with csv.Error as usual
+                    return self._mmap
+                self._mmap = mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        return self._mmap
+
+    def _sample(self, size=1024):
+        return self._mapped_file()[:size].decode(self.encoding, 'ignore')
+
+    def _lines(self, offset=0, block_size=1 << 20):
+        ''' Generator of decoded lines from the mapped file, line endings left on (like newline='').
+            Works through the file a block of whole lines at a time, so the splitting is done in C. '''
+        mm = self._mapped_file()
+        start, size = offset, len(mm)
+        if start and mm[start - 1:start] not in (b'\n', b'\r'): # Landed mid-line; skip to the start of the next
+            line_end = _line_end_re.search(mm, start)
+            start = line_end.end() if line_end else size
+        while start < size:
+            block = mm[start:start + block_size]
+            if start + len(block) < size: # Cut back to the last \n, so a \r\n is never split...
+                cut = block.rfind(b'\n') + 1
+                if cut:
+                    block = block[:cut]
+                else: # ...unless there isn't one in the block (a very long line, or \r endings)
+                    line_end = _line_end_re.search(mm, start + len(block) - 1) # -1 in case it ends on \r
+                    block = mm[start:line_end.end() if line_end else size]
+            for line in block.splitlines(keepends=True):
+                start += len(line)
+                self.offset = start
+                yield line.decode(self.encoding)
+
+    def _probe_csv(self):
+        ''' Look at the start of the file once: dialect and the first row '''
+        self.csv_dialect = csv.Sniffer().sniff(self._sample())
+        self._has_header = None # Only sniffed if the header check needs it; see sample_has_header
+        self._first_row = next(csv.reader(self._lines()), [])
+
+    def sample_has_header(self):
+        if self._has_header is None:
+            self._has_header = csv.Sniffer().has_header(self._sample())
+        return self._has_header
+
     def get_field_names_from_csv(self):
-        with open(self.file_path, 'r', newline='') as csv_file:
-            csv_reader = csv.reader(csv_file)
-            self._field_names = next(csv_reader)
+        self._field_names = list(self._first_row)
 
     @property
     def field_names(self):
@@ -162,63 +229,100 @@ class CSV_Gen:
 
 
     def __len__(self):
-        return functools.reduce(lambda acc, e: acc + 1, self._stream(), 0)
+        ''' Counts raw rows; no need to rename, select or transform anything to do that '''
+        self.check_file_path_and_field_names_compatible()
+        csv_reader = csv.reader(self._lines(), self.csv_dialect)
+        if self.ignore_first_row:
+            next(csv_reader, None)
+        last = deque(enumerate(csv_reader, 1), maxlen=1) # Runs the count in C
+        return last[0][0] if last else 0
 
 
     def set_csv_dialect(self):
-        with open(self.file_path, 'r', newline='') as csv_file:
-            csv_dialect = csv.Sniffer().sniff(csv_file.read(1024))
-            csv_file.seek(0) # Reset read position after sniff 
-        self.csv_dialect = csv_dialect
+        self._probe_csv()
 
 
     def check_file_path_and_field_names_compatible(self):
         if self._field_names == 'header':
-            with open(self.file_path, 'r', newline='') as csv_file:
-                if not csv.Sniffer().has_header(csv_file.read(1024)) :
-                    raise KeyError('Header missing from CSV file and fields not provided.')
+            if not self.sample_has_header():
+                raise KeyError('Header missing from CSV file and fields not provided.')
         elif self._field_names:
-            with open(self.file_path, 'r', newline='') as csv_file:
-                csv_reader = csv.reader(csv_file)
-                if len(self._field_names) != len(next(csv_reader)):
-                    raise KeyError('Fields provided do not match the CSV file columns.')
+            if len(self._field_names) != len(self._first_row):
+                raise KeyError('Fields provided do not match the CSV file columns.')
 
-    @staticmethod
-    def snakecase(string):
-        return string.lower().replace(' ', '_')
+    snakecase = staticmethod(snakecase)
 
     def _to_snakecase(self, string):
-        return string.lower().replace(' ', '_')
+        return snakecase(string)
 
 
     def _change_field_name(self, field_name):
-        fnmap = {**self._field_name_mappings, 
-            **{self._to_snakecase(k): v for k, v in self._field_name_mappings.items()}}
-        if field_name in fnmap or self._to_snakecase(field_name) in fnmap:
-            field_rename = fnmap.get(field_name) or fnmap.get(self._to_snakecase(field_name))
+        if field_name not in self._field_name_cache:
+            self._field_name_cache[field_name] = self._rename_field(field_name)
+        return self._field_name_cache[field_name]
+
+    def _rename_field(self, field_name):
+        fnmap = self._fnmap
+        snake_field_name = self._to_snakecase(field_name)
+        if field_name in fnmap or snake_field_name in fnmap:
+            field_rename = fnmap.get(field_name) or fnmap.get(snake_field_name)
             if callable(field_rename):
                 field_name = field_rename(field_name)
             else:
                 field_name = field_rename
-        map_all = self._field_name_mappings.get('^ALL')
-        if callable(map_all):
-            field_name = map_all(field_name)
+        if callable(self._map_all):
+            field_name = self._map_all(field_name)
         return field_name
 
+    def build_field_name_map(self):
+        ''' Renames keyed by both given and snakecased names; built once per apply_final_config '''
+        self._fnmap = {**self._field_name_mappings, 
+            **{self._to_snakecase(k): v for k, v in self._field_name_mappings.items()}}
+        self._map_all = self._field_name_mappings.get('^ALL')
+        self._field_name_cache = {} # Renames may have changed since last time, so start afresh
+
     def to_dict(self, values):
-        all_fields = True if not self._selected_fields else False
-        row_dict = {k: (self._value_transformers.get(k) 
-                            or self._value_transformers.get(self._to_snakecase(k)) 
-                            or (lambda x: x))(v)
-                        for k, v in zip(self._field_names, values) 
-                        if all_fields 
-                            or k in self._selected_fields
-                            or self._to_snakecase(k) in self._selected_fields}
-        return row_dict
+        if len(values) < self._row_width: # Short (or blank) row; only take what's there
+            return {name: fn(values[i]) for i, name, fn in self._row_plan if i < len(values)}
+        return self._row_fn(values)
+
+    def build_row_plan(self):
+        ''' Work out once which columns to read, what to call them and how to transform them '''
+        self._row_plan = []
+        for i, (k, snake_k) in enumerate(zip(self._field_names, self._snakecased_field_names)):
+            if (self._all_fields 
+                    or k in self._selected_fields_frozen 
+                    or snake_k in self._selected_fields_frozen):
+                transformer = (self._value_transformers.get(k)
+                                or self._value_transformers.get(snake_k)
+                                or _identity)
+                self._row_plan.append((i, k, transformer))
+        self._row_width = self._row_plan[-1][0] + 1 if self._row_plan else 0
+        self._row_fn = self.compile_row_plan(self._row_plan)
+
+    @staticmethod
+    def compile_row_plan(row_plan):
+        ''' Generate a function specialised to the row plan, e.g.
+                def _row(v, _n0=..., _t0=...): return {_n0: _t0(v[3]), _n1: v[5]}
+            so a row is one dict display: no loop, and untransformed fields skip the call '''
+        args, entries, namespace = ['v'], [], {}
+        for j, (i, name, fn) in enumerate(row_plan):
+            namespace[f'_n{j}'] = name
+            args.append(f'_n{j}=_n{j}')
+            if fn is _identity:
+                entries.append(f'_n{j}: v[{i}]')
+            else:
+                namespace[f'_t{j}'] = fn
+                args.append(f'_t{j}=_t{j}')
+                entries.append(f'_n{j}: _t{j}(v[{i}])')
+        source = f"def _row({', '.join(args)}):\n    return {{{', '.join(entries)}}}\n"
+        exec(compile(source, '<CSV_Gen row plan>', 'exec'), namespace)
+        return namespace['_row']
 
 
     def apply_final_config(self):
         self.check_file_path_and_field_names_compatible()
+        self.build_field_name_map()
         self._selected_fields = set([
                     *self._selected_fields, 
                     *[self._change_field_name(field) for field in self._selected_fields], 
@@ -229,6 +333,10 @@ class CSV_Gen:
         }
 
         self._field_names = [self._change_field_name(k) for k in self._field_names]
+        self._snakecased_field_names = [self._to_snakecase(k) for k in self._field_names]
+        self._all_fields = not self._selected_fields
+        self._selected_fields_frozen = frozenset(self._selected_fields) # Fixed for this stream
+        self.build_row_plan()
 
 
     def stream(self, n=0):
@@ -237,17 +345,24 @@ class CSV_Gen:
         else:
             yield from itertools.islice(self._stream(), n)
 
-    def _stream(self):
+    def stream_from_offset(self, byte_offset, n=0):
+        ''' As stream(), but starting from a byte offset into the file; best taken from self.offset,
+            as an offset in the middle of a quoted multi-line field can't be told apart from a row start'''
+        if not n:
+            yield from self._stream(byte_offset)
+        else:
+            yield from itertools.islice(self._stream(byte_offset), n)
+
+    def _stream(self, byte_offset=0):
         self.apply_final_config()
 
-        with open(self.file_path, 'r', newline='') as csv_file:
-            csv_reader = csv.reader(csv_file, self.csv_dialect)
-            
-            if self.ignore_first_row:
-                next(csv_reader)
+        csv_reader = csv.reader(self._lines(byte_offset), self.csv_dialect)
+
+        if self.ignore_first_row and not byte_offset:
+            next(csv_reader)
 
-            for row in csv_reader:
-                yield self.to_dict(row)
+        for row in csv_reader:
+            yield self.to_dict(row)
 
 
     def transform_field_value(self, field_to_transform):
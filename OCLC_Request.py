@@ -1,34 +1,58 @@
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import json
+import logging
+import logging.handlers
+import os
 import re
-import shelve
+import sqlite3
 import sys
+import threading
 import time
+from xml.etree import ElementTree
 
 import requests
-import xmltodict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from CSV_Gen import CSV_Gen
 
 
 
 endpoint_url = "http://classify.oclc.org/classify2/Classify"  # OCLC Classify API URL
-base_querystring = "?summary=true&maxRecs=1"
+base_params = {'summary': 'true', 'maxRecs': '1'}
 ns = {"classify": "http://classify.oclc.org"} 
 
+request_timeout = 10 # seconds
+worker_count = 16
+min_request_interval = 0.5 # seconds between requests to OCLC, across all worker threads
+max_lookup_hops = 3 # Multiple-works responses followed before giving up
+
+log = logging.getLogger('oclc') # Per-book detail is at DEBUG; run with -v to see it
+
+
+# One keep-alive session for every request, rather than a new connection per book
+session = requests.Session()
+session.headers.update({'User-Agent': 'r-subjectify'})
+session.mount('http://', HTTPAdapter(
+    pool_connections=4, 
+    pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=0.5, 
+                      status_forcelist=[429, 500, 502, 503, 504], 
+                      raise_on_status=False), # Give back the last response; non-200 handled below
+))
+
 
 
 csv_gen = CSV_Gen()
 
+person_noise_re = re.compile(r', editor|\[person\]|,\s[0-9]{4}-[0-9]{0,4}') # role, type tag, life dates
+
 
 def get_person_and_role(name_string):
-    if 'editor' in name_string:
-        role = 'editor'
-        name_string = name_string.replace(', editor', '')
-    else:
-        role = 'author'
-    tidy_name_string = name_string.replace('[person]', '').strip()
-    tidy_name_string = re.sub(r',\s{1}[0-9]{4}-[0-9]{0,4}', '', tidy_name_string)
+    role = 'editor' if 'editor' in name_string else 'author'
+    tidy_name_string = person_noise_re.sub('', name_string).strip()
     return tidy_name_string, role
 
 def get_organisation(name_string):
@@ -60,11 +84,23 @@ def split_isbn(isbn):
 
 
 
-cache = set()
+# Responses cached in SQLite, one connection kept open for the whole run;
+# cache holds the keys so misses don't touch the database at all
+cache_conn = sqlite3.connect('cache.sqlite', check_same_thread=False)
+cache_lock = threading.Lock() # Connection is shared by the worker threads
+cache_conn.execute('PRAGMA journal_mode=WAL')
+cache_conn.execute('PRAGMA synchronous=NORMAL')
+cache_conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)')
+
+cache = {key for key, in cache_conn.execute('SELECT key FROM cache')}
 
 
 LookupData = namedtuple('LookupData', ['type', 'value'])
 
+# Just the bits of a Classify response we use: response code, work identifier
+# (for multiple-work responses), most popular DDC and the work's attributes
+OCLCResponse = namedtuple('OCLCResponse', ['code', 'wi', 'ddc', 'work'])
+
 
 
 def determine_lookup_data(book):
@@ -85,46 +121,87 @@ def determine_lookup_data(book):
     return None
 
 
+rate_lock = threading.Lock()
+request_count = 0
+next_request_time = 0.0
+
+def wait_turn():
+    ''' Called before every request to OCLC (cache hits don't count). Requests go out one at a time,
+        at least min_request_interval apart, with a short rest every 31 and a long one every 149. '''
+    global request_count, next_request_time
+    with rate_lock: # Hold it while sleeping so every worker waits its turn
+        request_count += 1
+        pause = max(0.0, next_request_time - time.monotonic())
+        if request_count % 31 == 0:
+            log.info('Sleeping...')
+            pause += 5
+        if request_count % 149 == 0:
+            log.info('Long sleeping...')
+            pause += 30
+        time.sleep(pause)
+        next_request_time = time.monotonic() + min_request_interval
+
+
 def get_OCLC_data(lookup_data):
     
     
-    print(lookup_data)
-    if lookup_data in cache:
-        print(f'{lookup_data} in cache!')
-        with shelve.open('cache.shelve') as cache_shelve:
-            return cache_shelve[repr(lookup_data)]
-
+    log.debug('Looking up %s', lookup_data)
+    cache_key = repr(lookup_data)
+    if cache_key in cache:
+        log.debug('%s in cache!', lookup_data)
+        with cache_lock:
+            return cache_conn.execute('SELECT value FROM cache WHERE key = ?', (cache_key,)).fetchone()[0]
+
+    params = dict(base_params) # requests does the URL-encoding
     if lookup_data.type in ['isbn', 'wi']:
-        query = f'&{lookup_data.type}={lookup_data.value}'
+        params[lookup_data.type] = lookup_data.value
     elif lookup_data.type == 'author_title':
-        query = f'&author={lookup_data.value[0]}'
-        query += f'&title={lookup_data.value[1]}'
+        params['author'], params['title'] = lookup_data.value
     elif lookup_data.type == 'title':
-        query = f'&title={lookup_data.value}'
-
-    query = endpoint_url + base_querystring + query
+        params['title'] = lookup_data.value
 
+    wait_turn()
     try:
-        response = requests.get(query)
-    except TimeoutError: # if a timeout
-        print('Timeout error raised; waiting 5 minutes.')
+        response = session.get(endpoint_url, params=params, timeout=request_timeout)
+    except (TimeoutError, requests.exceptions.Timeout, requests.exceptions.ConnectionError): # if a timeout (or retries run out)
+        log.warning('Timeout error raised; waiting 5 minutes.')
         time.sleep(300)  # wait ages
         return get_OCLC_data(lookup_data) # then just call the function again?
     
     if response.status_code == 200:
-        with shelve.open('cache.shelve') as cache_shelve:
-            cache_shelve[repr(lookup_data)] = response.content
+        with cache_lock, cache_conn: # commits
+            cache_conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?)', (cache_key, response.content))
+        cache.add(cache_key)
         return response.content
 
 
-def OCLC_data_to_code_and_data_dict(data):
+def element_to_dict(element):
+    ''' Attributes and text of an element, keyed as xmltodict used to '''
+    element_dict = {f'@{k}': v for k, v in element.attrib.items()}
+    if element.text and element.text.strip():
+        element_dict['#text'] = element.text.strip()
+    return element_dict
+
+def parse_OCLC_data(data):
+    ''' Pull out the parts we need with targeted finds rather than converting the whole tree '''
     try:
-        xml_dict = xmltodict.parse(data) # Parse to dict
-        resp_code = xml_dict['classify']['response']['@code']
-        resp_data = xml_dict['classify']
-        return int(resp_code), resp_data
-    except KeyError:
-        return None, None
+        root = ElementTree.fromstring(data)
+    except (ElementTree.ParseError, TypeError): # TypeError if request failed (data is None)
+        return None
+
+    response = root.find('classify:response', ns)
+    if response is None or response.get('code') is None:
+        return None
+
+    multiple_work = root.find('classify:works/classify:work', ns)
+    most_popular = root.find('classify:recommendations/classify:ddc/classify:mostPopular', ns)
+    work = root.find('classify:work', ns)
+    return OCLCResponse(
+        code=int(response.get('code')),
+        wi=multiple_work.get('wi') if multiple_work is not None else None,
+        ddc=most_popular.get('nsfa') if most_popular is not None else None,
+        work=element_to_dict(work) if work is not None else None,
+    )
 
 
 
@@ -133,86 +210,134 @@ def OCLC_lookup(lookup_data):
     if not lookup_data:
         return None
 
-    OCLC_data = get_OCLC_data(lookup_data)
+    for _ in range(max_lookup_hops):
+        OCLC_data = get_OCLC_data(lookup_data)
 
-    resp_code, resp_data = OCLC_data_to_code_and_data_dict(OCLC_data)
-    print('Resp code:', resp_code)
-    if resp_code is None or resp_code >= 100:
-        return None
+        resp = parse_OCLC_data(OCLC_data)
+        resp_code = resp.code if resp else None
+        log.debug('Resp code: %s', resp_code)
+        if resp_code is None or resp_code >= 100:
+            return None
 
-    if resp_code == 4:
-        ''' If multiple, get work identifier and lookup again '''
-        wi = resp_data['works']['work']['@wi']
-        lookup_data2 = LookupData('wi', wi)
-        return OCLC_lookup(lookup_data2)
+        if resp_code == 4 and resp.wi:
+            ''' If multiple, get work identifier and lookup again '''
+            lookup_data = LookupData('wi', resp.wi)
+            continue
 
-    if resp_data.get('recommendations'):
-        return resp_data
+        return resp if resp.ddc else None
 
+    log.warning('Still multiple works after %s lookups; giving up on %s', max_lookup_hops, lookup_data)
+    return None
 
 
-if __name__ == '__main__':
-    csv_gen.file_path = 'bnb_records_to_1961.csv'
-    csv_gen.field_renames = [('^ALL', csv_gen.snakecase)]
 
-    rewrite_fields = []
+def process_book(i, book):
+    log.debug('Tackling row %s', i)
 
-    request_count = 0
+    lookup_data = determine_lookup_data(book)
 
-    for i, book in enumerate(csv_gen.stream()):      
+    OCLC_data = OCLC_lookup(lookup_data)
+    if OCLC_data:
+        log.debug('Result: %s', OCLC_data.ddc)
+        book['ddc'] = OCLC_data.ddc
+        if OCLC_data.work:
+            book['OCLC_search_dump'] = json.dumps(OCLC_data.work, ensure_ascii=False)
 
+    return book
 
-        ## up to 133374
-        if i < 133374:
-            continue
 
-        request_count += 1
-        if request_count % 31 == 0:
-            print('Sleeping...')
-            time.sleep(5)
-            print('------------------------------------------------')
-        if request_count % 149 == 0:
-            print('Long sleeping...')
-            time.sleep(30)
-            print('------------------------------------------------')
-            
-        print('Tackling row', i)
-
-        if not rewrite_fields:
-            rewrite_fields = [field for field in book]
-            rewrite_fields.append('ddc')
-            rewrite_fields.append('OCLC_search_dump')
-            with open('To1961.csv', 'a') as output:
-                writer = csv.DictWriter(output, fieldnames=rewrite_fields, restval='')
-                writer.writeheader()
- 
-        lookup_data = determine_lookup_data(book)
-    
-        OCLC_data = OCLC_lookup(lookup_data)
-        if OCLC_data:
-            try:
-                ddc_most_popular = OCLC_data['recommendations']['ddc']['mostPopular']['@nsfa']
-            except TypeError:
-                try:
-                    ddc_most_popular = OCLC_data['recommendations']['ddc']['mostPopular'][0]['@nsfa']
-                except:
-                    pass
-            except KeyError:
-                pass
-            finally:
+def process_books(books):
+    ''' Run process_book over (i, book) pairs in a thread pool, yielding (i, book) results in order.
+        Only a few batches' worth are submitted at a time, so the CSV isn't read in all at once. '''
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        pending = deque()
+        for i, book in books:
+            pending.append((i, executor.submit(process_book, i, book)))
+            if len(pending) >= worker_count * 4:
+                i, future = pending.popleft()
+                yield i, future.result()
+        while pending:
+            i, future = pending.popleft()
+            yield i, future.result()
+
+
+def read_checkpoint(checkpoint_path):
+    ''' Furthest (row, input offset, output size) checkpoint; (0, 0, None) if there isn't one.
+        Each line of the file is "row input_offset output_size": the next row to do, where it starts
+        in the input CSV, and how long the output file was with everything before it written. '''
+    checkpoint = (0, 0, None)
+    try:
+        with open(checkpoint_path) as checkpoints:
+            for line in checkpoints:
                 try:
-                    print('Result:', ddc_most_popular)
-                    book['ddc'] = ddc_most_popular
-                    book['OCLC_search_dump'] = repr(dict(OCLC_data['work']))
-                except:
-                    pass
+                    row, input_offset, output_size = map(int, line.split())
+                except ValueError: # Half-written line from a crash
+                    continue
+                if row >= checkpoint[0]:
+                    checkpoint = (row, input_offset, output_size)
+    except FileNotFoundError:
+        pass
+    return checkpoint
+
 
-        with open('To1961.csv', 'a') as output:
-            writer = csv.DictWriter(output, fieldnames=rewrite_fields, restval='')
-            writer.writerow(book)
 
+if __name__ == '__main__':
+    # Debug lines are held and written out 100 at a time; anything INFO or above goes straight out
+    log.addHandler(logging.handlers.MemoryHandler(
+        capacity=100, flushLevel=logging.INFO, target=logging.StreamHandler()))
+    log.setLevel(logging.DEBUG if '-v' in sys.argv[1:] else logging.INFO)
 
-        print('------------------------------------------------')
+    csv_gen.file_path = 'bnb_records_to_1961.csv'
+    csv_gen.field_renames = [('^ALL', csv_gen.snakecase)]
+
+    rewrite_fields = []
+    flush_every = 100 # rows; a checkpoint is written at each flush
+    checkpoint_path = 'bnb_records_to_1961.csv.offset'
+
+    output_path = 'To1961.csv'
+
+    ## up to 133374; after that, carry on from the last checkpoint
+    start_row = 133374
+    checkpoint_row, checkpoint_offset, checkpoint_output_size = read_checkpoint(checkpoint_path)
+    resume_row = max(start_row, checkpoint_row)
+    row_offsets = {} # row -> offset just past it, for rows read but not yet written
+
+    # Drop anything written after the checkpoint (those rows get done again)
+    if checkpoint_output_size is not None and os.path.exists(output_path):
+        with open(output_path, 'r+b') as output:
+            output.truncate(checkpoint_output_size)
+
+    def read_books():
+        row_start = checkpoint_offset
+        for i, book in enumerate(csv_gen.stream_from_offset(checkpoint_offset), checkpoint_row):
+            if i == resume_row and resume_row > checkpoint_row: # Save having to parse up to here again
+                output.flush()
+                checkpoints.write(f'{i} {row_start} {output.tell()}\n')
+                checkpoints.flush()
+            if i >= resume_row:
+                row_offsets[i] = csv_gen.offset
+                yield i, book
+            row_start = csv_gen.offset
+
+    with open(output_path, 'a', buffering=1 << 20, newline='') as output, \
+            open(checkpoint_path, 'a') as checkpoints:
+        writer = csv.writer(output)
+        for row_count, (i, book) in enumerate(process_books(read_books()), 1):
+
+            if not rewrite_fields:
+                rewrite_fields = [field for field in book if field not in ('ddc', 'OCLC_search_dump')]
+                rewrite_fields.append('ddc')
+                rewrite_fields.append('OCLC_search_dump')
+                rewrite_fields = tuple(rewrite_fields)
+                if not output.tell(): # New file; resumed runs already have their header
+                    writer.writerow(rewrite_fields)
+
+            writer.writerow([book.get(field, '') for field in rewrite_fields])
+            offset = row_offsets.pop(i)
+            if row_count % flush_every == 0:
+                output.flush()
+                checkpoints.write(f'{i + 1} {offset} {output.tell()}\n')
+                checkpoints.flush()
 
 
 